@@ -1,5 +1,11 @@
+import functools
 import os
-import sys
+import queue
+import re
+import shlex
+import stat
+import subprocess
+import threading
 import traceback
 from PySide2 import QtCore, QtGui
 import maya.cmds as cmds
@@ -7,6 +13,99 @@ import maya.mel as mel
 import maya.OpenMaya as om
 
 
+# Caches a Maya query for the duration of one BPlayblast.execute() call
+def _memoized_during_execute(func):
+    @functools.wraps(func)
+    def wrapper(self):
+        if self._exec_cache is None:
+            return func(self)
+
+        if func.__name__ not in self._exec_cache:
+            self._exec_cache[func.__name__] = func(self)
+
+        return self._exec_cache[func.__name__]
+
+    return wrapper
+
+
+# Runs one ffmpeg encode. Frames are written to stdin from a worker thread so encoding overlaps capture,
+# and stderr is read on another so ffmpeg never stalls on a full pipe. Signals reach the main thread queued.
+class _FfmpegEncode(QtCore.QObject):
+
+    output_read = QtCore.Signal(str)
+    finished = QtCore.Signal(object, int)
+
+    def __init__(self, command, max_buffered_frames):
+        super(_FfmpegEncode, self).__init__()
+
+        self._command = command
+        self._frame_queue = queue.Queue(maxsize=max_buffered_frames)
+        self._process = None
+        self._write_failed = False
+
+    def start(self):
+        if os.name == "nt":
+            args = self._command
+        else:
+            args = shlex.split(self._command)
+
+        self._process = subprocess.Popen(args,
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.DEVNULL,
+                                         stderr=subprocess.PIPE,
+                                         creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0))
+
+        for target in (self._write_frames, self._read_output):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def is_running(self):
+        return not self._write_failed and self._process.poll() is None
+
+    def write_frame(self, frame_data):
+        if not self.is_running():
+            return False
+
+        # Blocks once max_buffered_frames are waiting on ffmpeg, which bounds memory
+        self._frame_queue.put(frame_data)
+        return True
+
+    def close_input(self):
+        self._frame_queue.put(None)
+
+    def kill(self):
+        self._process.kill()
+        self.close_input()
+        self._process.wait()
+
+    def _write_frames(self):
+        while True:
+            frame_data = self._frame_queue.get()
+            if frame_data is None:
+                break
+
+            # Keep draining after a failure so write_frame never blocks on a full queue
+            if self._write_failed:
+                continue
+
+            try:
+                self._process.stdin.write(frame_data)
+            except OSError:
+                self._write_failed = True
+
+        try:
+            self._process.stdin.close()
+        except OSError:
+            pass
+
+    def _read_output(self):
+        for output in iter(functools.partial(self._process.stderr.read1, 4096), b""):
+            self.output_read.emit(output.decode("utf-8", "replace"))
+
+        self.finished.emit(self, self._process.wait())
+
+
 class BPlayblast(QtCore.QObject):
 
     VERSION = "0.0.1"
@@ -19,11 +118,19 @@ class BPlayblast(QtCore.QObject):
     DEFAULT_CONTAINER = "mp4"
     DEFAULT_ENCODER = "h264"
     DEFAULT_H264_QUALITY = "High"
-    DEFAULT_H264_PRESET = "fast"
+    DEFAULT_H264_PRESET = "veryfast"  # Knee of the x264 speed/size curve, plenty for review media
     DEFAULT_IMAGE_QUALITY = 100
 
+    DEFAULT_HW_ENCODER = "h264_nvenc"
+    DEFAULT_HW_ACCEL = True
+
     DEFAULT_PADDING = 4
 
+    MAX_CONCURRENT_ENCODES = 2
+    MAX_BUFFERED_FRAMES = 32
+
+    LOG_FLUSH_INTERVAL = 100
+
     DEFAULT_VISIBILITY = "Viewport"
 
     RESOLUTION_LOOKUP = {
@@ -33,17 +140,22 @@ class BPlayblast(QtCore.QObject):
         "HD 540": (960, 540)
     }
 
-    FRAME_RANGE_PRESETS = [
+    FRAME_RANGE_PRESETS = (
         "Render",
         "Playback",
         "Animation"
-    ]
+    )
+    _FRAME_RANGE_PRESETS_SET = frozenset(FRAME_RANGE_PRESETS)
+
+    _RESOLUTION_PRESETS_STR = ", ".join(f"'{preset}'" for preset in RESOLUTION_LOOKUP)
+    _FRAME_RANGE_PRESETS_STR = ", ".join(f"'{preset}'" for preset in FRAME_RANGE_PRESETS)
 
     VIDEO_ENCODER_LOOKUP = {
-        "mov": ["h264"],
-        "mp4": ["h264"],
-        "Image": ["jpg", "png", "tif"]
+        "mov": ("h264",),
+        "mp4": ("h264",),
+        "Image": ("jpg", "png", "tif")
     }
+    _VIDEO_ENCODER_SETS = {container: frozenset(encoders) for container, encoders in VIDEO_ENCODER_LOOKUP.items()}
 
     H264_QUALITIES = {
         "Very high": 18,
@@ -51,15 +163,38 @@ class BPlayblast(QtCore.QObject):
         "Medium": 23,
         "Low": 26
     }
+    H264_QUALITIES_KEYS = frozenset(H264_QUALITIES)
 
-    H264_PRESETS = [
+    H264_PRESETS = (
         "veryslow",
         "slow",
         "medium",
         "fast",
         "faster",
+        "veryfast",
         "ultrafast"
-    ]
+    )
+    _H264_PRESETS_SET = frozenset(H264_PRESETS)
+
+    _FRAME_RATE_MAP = {
+        "game": 15.0,
+        "film": 24.0,
+        "pal": 25.0,
+        "ntsc": 30.0,
+        "show": 48.0,
+        "palf": 50.0,
+        "ntscf": 60.0
+    }
+
+    NVENC_PRESET_LOOKUP = {
+        "veryslow": "p7",
+        "slow": "p6",
+        "medium": "p5",
+        "fast": "p4",
+        "faster": "p3",
+        "veryfast": "p3",
+        "ultrafast": "p1"
+    }
 
     VIEWPORT_VISIBILITY_LOOKUP = [
         ["Controllers", "controllers"],
@@ -101,6 +236,11 @@ class BPlayblast(QtCore.QObject):
         ["Selection Highlighting", "sel"],
     ]
 
+    _FLAG_NAMES = frozenset(item[1] for item in VIEWPORT_VISIBILITY_LOOKUP)
+    _VISIBILITY_FLAG_KEYS = tuple(item[1] for item in VIEWPORT_VISIBILITY_LOOKUP)
+    _STATE_STRING_FLAG_RE = re.compile(r"-(\w+)\s+(\d+|on|off|true|false)\b")
+    _TOKEN_RE = re.compile(r"\{(\w+)\}")
+
     VIEWPORT_VISIBILITY_PRESET = {
         "Viewport": [],
         "Geo": ["NURBS Surfaces", "Polygons"],
@@ -108,11 +248,39 @@ class BPlayblast(QtCore.QObject):
     }
 
     output_logged = QtCore.Signal(str)
+    encode_finished = QtCore.Signal(str)
+
+    __slots__ = (
+        "_exec_cache",
+        "_log_to_maya",
+        "_log_sinks",
+        "_log_buffer",
+        "_log_timer",
+        "_ffmpeg_path",
+        "_ffmpeg_validated_path",
+        "_hw_accel",
+        "_hw_encoder_available",
+        "_ffmpeg_encode",
+        "_encode_jobs",
+        "_camera",
+        "_resolution_preset",
+        "_width_height",
+        "_frame_range_preset",
+        "_start_frame",
+        "_end_frame",
+        "_container_format",
+        "_encoder",
+        "_h264_quality",
+        "_h264_preset",
+        "_image_quality"
+    )
 
     def __init__(self, ffmpeg_path=None, log_to_maya=True):
 
         super(BPlayblast, self).__init__()
 
+        self._initialize_internals()
+
         self.set_ffmpeg_path(ffmpeg_path)
         self.set_maya_logging_enabled(log_to_maya)
 
@@ -123,29 +291,111 @@ class BPlayblast(QtCore.QObject):
         self.set_encoding(BPlayblast.DEFAULT_CONTAINER, BPlayblast.DEFAULT_ENCODER)
         self.set_h264_settings(BPlayblast.DEFAULT_H264_QUALITY, BPlayblast.DEFAULT_H264_PRESET)
         self.set_image_settings(BPlayblast.DEFAULT_IMAGE_QUALITY)
+        self.set_hw_accel_enabled(BPlayblast.DEFAULT_HW_ACCEL)
 
         self.initialize_ffmpeg_process()
 
+    @classmethod
+    def _default(cls):
+        # The class defaults are known to be valid, so skip the set_* validation and its Maya queries
+        playblast = cls.__new__(cls)
+        super(BPlayblast, playblast).__init__()
+
+        playblast._initialize_internals()
+
+        playblast.set_ffmpeg_path(None)
+        playblast._log_to_maya = True
+
+        playblast._camera = cls.DEFAULT_CAMERA
+        playblast._resolution_preset = cls.DEFAULT_RESOLUTION
+        playblast._width_height = None
+        playblast._frame_range_preset = cls.DEFAULT_FRAME_RANGE
+        playblast._start_frame = None
+        playblast._end_frame = None
+
+        playblast._container_format = cls.DEFAULT_CONTAINER
+        playblast._encoder = cls.DEFAULT_ENCODER
+        playblast._h264_quality = cls.DEFAULT_H264_QUALITY
+        playblast._h264_preset = cls.DEFAULT_H264_PRESET
+        playblast._image_quality = cls.DEFAULT_IMAGE_QUALITY
+        playblast._hw_accel = cls.DEFAULT_HW_ACCEL
+
+        playblast.initialize_ffmpeg_process()
+
+        return playblast
+
+    def _initialize_internals(self):
+        self._exec_cache = None
+
+        self._log_sinks = []
+        self._log_buffer = []
+        self._log_timer = QtCore.QTimer(self)
+        self._log_timer.setInterval(BPlayblast.LOG_FLUSH_INTERVAL)
+        self._log_timer.timeout.connect(self._flush_log)
+
     def set_maya_logging_enabled(self, enabled):
         self._log_to_maya = enabled
 
+    def register_log_sink(self, sink):
+        # Plain callables are called directly, avoiding the signal dispatch of output_logged
+        self._log_sinks.append(sink)
+
+    def unregister_log_sink(self, sink):
+        if sink in self._log_sinks:
+            self._log_sinks.remove(sink)
+
+    def has_log_listeners(self):
+        return self._log_to_maya or self._log_sinks or self.receivers(QtCore.SIGNAL("output_logged(QString)")) > 0
+
+    def _dispatch_log(self, text):
+        for sink in self._log_sinks:
+            sink(text)
+
+        self.output_logged.emit(text)
+
     def log_error(self, text):
+        if not self.has_log_listeners():
+            return
+
+        self._flush_log()
+
         if self._log_to_maya:
-            om.MGlobal.displayError("[BPlayblast] {0}".format(text))
+            om.MGlobal.displayError("[BPlayblast] %s" % text)
 
-        self.output_logged.emit("[ERROR] {0}".format(text))
+        self._dispatch_log("[ERROR] %s" % text)
 
     def log_warning(self, text):
+        if not self.has_log_listeners():
+            return
+
+        self._flush_log()
+
         if self._log_to_maya:
-            om.MGlobal.displayWarning("[BPlayblast] {0}".format(text))
+            om.MGlobal.displayWarning("[BPlayblast] %s" % text)
 
-        self.output_logged.emit("[WARNING] {0}".format(text))
+        self._dispatch_log("[WARNING] %s" % text)
 
     def log_output(self, text):
+        if not self.has_log_listeners():
+            return
+
+        # Batched so verbose ffmpeg output doesn't repaint the script editor for every read
+        self._log_buffer.append(text)
+        if not self._log_timer.isActive():
+            self._log_timer.start()
+
+    def _flush_log(self):
+        self._log_timer.stop()
+        if not self._log_buffer:
+            return
+
+        text = "\n".join(self._log_buffer)
+        self._log_buffer = []
+
         if self._log_to_maya:
             om.MGlobal.displayInfo(text)
 
-        self.output_logged.emit(text)
+        self._dispatch_log(text)
 
     def set_ffmpeg_path(self, ffmpeg_path):
         if ffmpeg_path:
@@ -153,44 +403,124 @@ class BPlayblast(QtCore.QObject):
         else:
             self._ffmpeg_path = BPlayblast.DEFAULT_FFMPEG_PATH
 
+        self._hw_encoder_available = None
+        self._ffmpeg_validated_path = None
+
     def get_ffmpeg_path(self):
         return self._ffmpeg_path
 
+    def set_hw_accel_enabled(self, enabled):
+        self._hw_accel = enabled
+
+    def is_hw_encoder_available(self):
+        if self._hw_encoder_available is None:
+            # Listing the encoder is not enough, it also needs a GPU able to run it
+            probe_process = QtCore.QProcess()
+            probe_process.start(self._ffmpeg_path, ["-hide_banner", "-loglevel", "error",
+                                                    "-f", "lavfi", "-i", "nullsrc=s=256x256:d=0.1",
+                                                    "-c:v", BPlayblast.DEFAULT_HW_ENCODER, "-f", "null", "-"])
+
+            self._hw_encoder_available = (probe_process.waitForFinished()
+                                          and probe_process.exitStatus() == QtCore.QProcess.NormalExit
+                                          and probe_process.exitCode() == 0)
+            if not self._hw_encoder_available:
+                self.log_output(f"{BPlayblast.DEFAULT_HW_ENCODER} not available, encoding with libx264")
+
+        return self._hw_encoder_available
+
     def validate_ffmpeg(self):
+        if self._ffmpeg_validated_path and self._ffmpeg_validated_path == self._ffmpeg_path:
+            return True
+
         if not self._ffmpeg_path:
             self.log_error("ffmpeg executable path not set")
             return False
-        elif not os.path.exists(self._ffmpeg_path):
+
+        try:
+            ffmpeg_stat = os.stat(self._ffmpeg_path)
+        except OSError:
             self.log_error(f"ffmpeg executable path does not exists: {self._ffmpeg_path}")
             return False
-        elif os.path.isdir(self._ffmpeg_path):
+
+        if stat.S_ISDIR(ffmpeg_stat.st_mode):
             self.log_error(f"Invalid ffmpeg path: {self._ffmpeg_path}")
             return False
 
+        self._ffmpeg_validated_path = self._ffmpeg_path
         return True
     
     def initialize_ffmpeg_process(self):
-        self._ffmpeg_process = QtCore.QProcess()
-        self._ffmpeg_process.readyReadStandardError.connect(self.process_ffmpeg_output)
+        self._ffmpeg_encode = None
+        self._encode_jobs = {}
+
+    def wait_for_encode_slot(self):
+        while len(self._encode_jobs) >= BPlayblast.MAX_CONCURRENT_ENCODES:
+            event_loop = QtCore.QEventLoop()
+            self.encode_finished.connect(event_loop.quit)
+            event_loop.exec_()
+            self.encode_finished.disconnect(event_loop.quit)
     
-    def execute_ffmpeg_cmd(self, command):
-        self._ffmpeg_process.start(command)
-        if self._ffmpeg_process.waitForStarted():
-            while self._ffmpeg_process.state() != QtCore.QProcess.NotRunning:
-                QtCore.QCoreApplication.processEvents()
-                QtCore.QThread.usleep(10)
-
-    def process_ffmpeg_output(self):
-        byte_array_output = self._ffmpeg_process.readAllStandardError()
-
-        if sys.version_info.major < 3:
-            output = str(byte_array_output)
-        else:
-            output = str(byte_array_output, "utf-8")
-        
-        self.log_output(output)
+    def start_ffmpeg_cmd(self, command):
+        self.wait_for_encode_slot()
+
+        ffmpeg_encode = _FfmpegEncode(command, BPlayblast.MAX_BUFFERED_FRAMES)
+        ffmpeg_encode.output_read.connect(self.log_output)
+        ffmpeg_encode.finished.connect(self.on_ffmpeg_finished)
+
+        try:
+            ffmpeg_encode.start()
+        except (OSError, ValueError) as e:
+            self.log_error(f"Failed to start ffmpeg: {e}")
+            ffmpeg_encode.deleteLater()
+            return False
+
+        self._ffmpeg_encode = ffmpeg_encode
+        self._encode_jobs[ffmpeg_encode] = None
+
+        return True
+
+    def write_ffmpeg_frame(self, frame_data):
+        return self._ffmpeg_encode.write_frame(frame_data)
+
+    def abort_ffmpeg_cmd(self):
+        ffmpeg_encode = self._ffmpeg_encode
+        self._ffmpeg_encode = None
+
+        self._encode_jobs.pop(ffmpeg_encode, None)
+        ffmpeg_encode.kill()
+
+    def finish_ffmpeg_cmd(self, output_path, show_in_viewer):
+        ffmpeg_encode = self._ffmpeg_encode
+        self._ffmpeg_encode = None
+
+        # Always end the input, even for a dead ffmpeg, so the writer thread exits and stdin is closed
+        ffmpeg_encode.close_input()
+
+        # ffmpeg may have exited while the last frames were written; on_ffmpeg_finished already reported it
+        if ffmpeg_encode not in self._encode_jobs:
+            return
+
+        # The encode completes in the background while the next playblast is captured
+        self._encode_jobs[ffmpeg_encode] = (output_path, show_in_viewer)
+
+    def on_ffmpeg_finished(self, ffmpeg_encode, exit_code):
+        job = self._encode_jobs.pop(ffmpeg_encode, None)
+        ffmpeg_encode.deleteLater()
+
+        if not job:
+            if ffmpeg_encode is self._ffmpeg_encode:
+                self.log_error("ffmpeg exited before the playblast finished. See script editor for details")
+            return
+
+        output_path, show_in_viewer = job
+        if exit_code != 0:
+            self.log_error(f"ffmpeg failed to encode: {output_path}. See script editor for details")
+        elif show_in_viewer:
+            self.open_in_viewer(output_path)
+
+        self.encode_finished.emit(output_path)
     
-    def encode_h264(self, source_path, output_path, start_frame):
+    def encode_h264(self, output_path, start_frame):
         frame_rate = self.get_frame_rate()
 
         audio_file_path, audio_frame_offset = self.get_audio_attributes()
@@ -201,45 +531,45 @@ class BPlayblast(QtCore.QObject):
         preset = self._h264_preset
 
         ffmpeg_cmd = self._ffmpeg_path
-        ffmpeg_cmd += f' -y -framerate {frame_rate} -i "{source_path}"'
+        ffmpeg_cmd += f' -y -f image2pipe -c:v png -framerate {frame_rate} -i pipe:0'
 
         if audio_file_path:
             ffmpeg_cmd += f' -ss {audio_offset} -i "{audio_file_path}"'
         
-        ffmpeg_cmd += f' -c:v libx264 -crf:v {crf} -preset:v {preset} -profile high -level 4.0 -pix_fmt yuv420p'
+        if self._hw_accel and self.is_hw_encoder_available():
+            nvenc_preset = BPlayblast.NVENC_PRESET_LOOKUP[preset]
+            nvenc_tune = "ll" if self._h264_quality == "Low" else "hq"
+
+            ffmpeg_cmd += f' -c:v {BPlayblast.DEFAULT_HW_ENCODER} -preset:v {nvenc_preset} -tune:v {nvenc_tune} -rc:v vbr -cq:v {crf} -b:v 0 -profile:v high -pix_fmt yuv420p'
+        else:
+            ffmpeg_cmd += f' -c:v libx264 -crf:v {crf} -preset:v {preset} -profile high -level 4.0 -pix_fmt yuv420p'
+
+            if self._h264_quality == "Low":
+                # Review-only quality, skip lookahead and b-frames
+                ffmpeg_cmd += ' -tune zerolatency'
 
         if audio_file_path:
-            ffmpeg += f' -filter_complex "[1:0] apad" -shortest'
+            # Pad the audio so -shortest always ends on the last video frame
+            ffmpeg_cmd += f' -map 0:v:0 -map 1:a:0 -c:a aac -b:a 192k -af apad -shortest'
 
         ffmpeg_cmd += f' "{output_path}"'
 
         self.log_output(ffmpeg_cmd)
 
-        self.execute_ffmpeg_cmd(ffmpeg_cmd)
+        return self.start_ffmpeg_cmd(ffmpeg_cmd)
 
+    @_memoized_during_execute
     def get_frame_rate(self):
         rate_str = cmds.currentUnit(q=True, time=True)
 
-        if rate_str == "game":
-            frame_rate = 15.0
-        elif rate_str == "film":
-            frame_rate = 24.0
-        elif rate_str == "pal":
-            frame_rate = 25.0
-        elif rate_str == "ntsc":
-            frame_rate = 30.0
-        elif rate_str == "show":
-            frame_rate = 48.0
-        elif rate_str == "palf":
-            frame_rate = 50.0
-        elif rate_str == "ntscf":
-            frame_rate = 60.0
-        elif rate_str.endswith("fps"):
-            frame_rate = float(rate_str[0:-3])
-        else:
-            raise RuntimeError("Unsupported frame rate: {0}".format(rate_str))
-        
-        return frame_rate
+        frame_rate = BPlayblast._FRAME_RATE_MAP.get(rate_str)
+        if frame_rate is not None:
+            return frame_rate
+
+        if rate_str.endswith("fps"):
+            return float(rate_str[0:-3])
+
+        raise RuntimeError("Unsupported frame rate: {0}".format(rate_str))
     
     def get_audio_attributes(self):
         sound_node = mel.eval("timeControl -q -sound $gPlayBackSlider;")
@@ -249,23 +579,18 @@ class BPlayblast(QtCore.QObject):
             if file_info.exists():
                 offset = cmds.getAttr(f"{sound_node}.offset")
                 return (file_path, offset)
-            
-        else:
-            return (None, None)
+
+        return (None, None)
 
     def get_audio_offset_in_sec(self, start_frame, audio_frame_offset, frame_rate):
         return (start_frame - audio_frame_offset) / frame_rate
 
-    def remove_temp_dir(self, temp_dir_path):
-        playblast_dir = QtCore.QDir(temp_dir_path)
-        playblast_dir.setNameFilters(["*.png"])
-        playblast_dir.setFilter(QtCore.QDir.Files)
-
-        for file in playblast_dir.entryList():
-            playblast_dir.remove(file)
+    def get_scratch_root_path(self):
+        # tmpfs keeps the per-frame scratch image in RAM where available
+        if os.path.isdir("/dev/shm"):
+            return "/dev/shm"
 
-        if not playblast_dir.rmdir(temp_dir_path):
-            self.log_warning(f"Failed to remove temporary directory: {temp_dir_path}")
+        return QtCore.QDir.tempPath()
 
     def open_in_viewer(self, path):
         if not os.path.exists(path):
@@ -283,30 +608,28 @@ class BPlayblast(QtCore.QObject):
     def set_resolution(self, resolution):
         self._resolution_preset = None
 
-        try:
+        if isinstance(resolution, str) and resolution in BPlayblast.RESOLUTION_LOOKUP:
             width_height = self.preset_to_resolution(resolution)
             self._resolution_preset = resolution
-        except:
+        else:
             width_height = resolution
 
-        valid_resolution = True
-        try:
-            if not (isinstance(width_height[0], int) and isinstance(width_height[1], int)):
-                valid_resolution = False
-        except:
-            valid_resolution = False
+        valid_resolution = (isinstance(width_height, (tuple, list))
+                            and len(width_height) == 2
+                            and isinstance(width_height[0], int)
+                            and isinstance(width_height[1], int))
 
         if valid_resolution:
             if width_height[0] <= 0 or width_height[1] <= 0:
                 self.log_error(f"Invalid resolution: {width_height}. Values must be greater than zero.")
                 return
         else:
-            presets = [f"'{preset}'" for preset in BPlayblast.RESOLUTION_LOOKUP.keys()]
-            self.log_error(f"Invalid resolution: {width_height}. Expected one of [int, int], {', '.join(presets)}")
+            self.log_error(f"Invalid resolution: {width_height}. Expected one of [int, int], {BPlayblast._RESOLUTION_PRESETS_STR}")
             return
         
         self._width_height = (width_height[0], width_height[1])
 
+    @_memoized_during_execute
     def get_resolution_width_height(self):
         if self._resolution_preset:
             return self.preset_to_resolution(self._resolution_preset)
@@ -321,7 +644,7 @@ class BPlayblast(QtCore.QObject):
         elif resolution_preset in BPlayblast.RESOLUTION_LOOKUP.keys():
             return BPlayblast.RESOLUTION_LOOKUP[resolution_preset]
         else:
-            raise RuntimeError(f"Invalid resolution preset: {resolution_preset}")
+            raise KeyError(f"Invalid resolution preset: {resolution_preset}")
         
     def preset_to_frame_range(self, frame_range_preset):
         if frame_range_preset == "Render":
@@ -334,27 +657,29 @@ class BPlayblast(QtCore.QObject):
             start_frame = int(cmds.playbackOptions(q=True, animationStartTime=True))
             end_frame = int(cmds.playbackOptions(q=True, animationEndTime=True))
         else:
-            raise RuntimeError(f"Invalid frame range preset: {frame_range_preset}")
-        
+            raise KeyError(f"Invalid frame range preset: {frame_range_preset}")
+
         return (start_frame, end_frame)
-    
+
     def set_encoding(self, container_format, encoder):
-        if container_format not in (containers := BPlayblast.VIDEO_ENCODER_LOOKUP.keys()):
-            self.log_error(f"Invalid container: {container_format}. Expected one of {containers}")
+        if container_format not in BPlayblast.VIDEO_ENCODER_LOOKUP:
+            self.log_error(f"Invalid container: {container_format}. Expected one of {list(BPlayblast.VIDEO_ENCODER_LOOKUP)}")
+            return
         
-        if encoder not in (encoders := BPlayblast.VIDEO_ENCODER_LOOKUP[container_format]):
-            self.log_error(f"Invalid encoder: {encoder}. Expected one of {encoders}")
+        if encoder not in BPlayblast._VIDEO_ENCODER_SETS[container_format]:
+            self.log_error(f"Invalid encoder: {encoder}. Expected one of {list(BPlayblast.VIDEO_ENCODER_LOOKUP[container_format])}")
+            return
 
         self._container_format = container_format
         self._encoder = encoder
 
     def set_h264_settings(self, quality, preset):
-        if not quality in (h264_qualities := BPlayblast.H264_QUALITIES.keys()):
-            self.log_error(f"Invalid h264 quality: {quality}. Expected of {h264_qualities}")
+        if not quality in BPlayblast.H264_QUALITIES_KEYS:
+            self.log_error(f"Invalid h264 quality: {quality}. Expected of {list(BPlayblast.H264_QUALITIES)}")
             return
         
-        if preset not in (h264_presets := BPlayblast.H264_PRESETS):
-            self.log_error(f"Invalid h264 preset: {preset}. Expected of {h264_presets}")
+        if preset not in BPlayblast._H264_PRESETS_SET:
+            self.log_error(f"Invalid h264 preset: {preset}. Expected of {list(BPlayblast.H264_PRESETS)}")
             return
         
         self._h264_quality = quality
@@ -383,12 +708,13 @@ class BPlayblast(QtCore.QObject):
             return
         
         self._frame_range_preset = None
-        if frame_range in BPlayblast.FRAME_RANGE_PRESETS:
+        if isinstance(frame_range, str) and frame_range in BPlayblast._FRAME_RANGE_PRESETS_SET:
             self._frame_range_preset = frame_range
         
         self._start_frame = resolve_frame_range[0]
         self._end_frame = resolve_frame_range[1]
 
+    @_memoized_during_execute
     def get_start_end_frame(self):
         if self._frame_range_preset:
             return self.preset_to_frame_range(self._frame_range_preset)
@@ -396,7 +722,14 @@ class BPlayblast(QtCore.QObject):
         return (self._start_frame, self._end_frame)
 
     def set_camera(self,  camera):  
-        if camera and camera not in cmds.listCameras():
+        if not camera:
+            self._camera = None
+            return
+
+        if camera == self._camera:
+            return
+
+        if camera not in self.get_valid_cameras():
             self.log_error(f"Camera does not exist: {camera}")
             camera = None
 
@@ -405,26 +738,38 @@ class BPlayblast(QtCore.QObject):
     def set_active_camera(self, camera_name):
         model_panel = self.get_viewport_panel()
         if model_panel:
-            mel.eval(f"lookThroughModelPanel {camera_name} {model_panel}")
+            self._set_active_camera_on_panel(camera_name, model_panel)
         else:
             self.log_error("Failed to set active camera. A viewport is not active.")
 
+    def _set_active_camera_on_panel(self, camera_name, model_panel):
+        cmds.lookThru(model_panel, camera_name)
+
+    @_memoized_during_execute
+    def get_valid_cameras(self):
+        return frozenset(cmds.listCameras() or [])
+
     def get_active_camera(self):
         model_panel = self.get_viewport_panel()
         if not model_panel:
             self.log_error("Failed to get active camera. A viewport is not active.")
             return None
         
+        return self._get_active_camera_on_panel(model_panel)
+
+    def _get_active_camera_on_panel(self, model_panel):
         return cmds.modelPanel(model_panel, q=True, camera=True) # returns the camera name for a given model_panel
 
+    @_memoized_during_execute
     def get_viewport_panel(self):
         model_panel = cmds.getPanel(withFocus=True) # dans la liste de panel, returns active view panel's name
         try:
             cmds.modelPanel(model_panel, q=True, modelEditor=True)
             return model_panel
-        except:
+        except RuntimeError:
             self.log_error("Failed to get active view")
 
+    @_memoized_during_execute
     def get_scene_name(self):
         scene_name = cmds.file(q=True, sceneName=True, shortName=True)
         if scene_name:
@@ -434,6 +779,7 @@ class BPlayblast(QtCore.QObject):
 
         return scene_name
 
+    @_memoized_during_execute
     def get_project_dir_path(self):
         return cmds.workspace(q=True, rootDirectory=True)
     
@@ -445,10 +791,21 @@ class BPlayblast(QtCore.QObject):
         
         viewport_visibility = []
         try:
+            # One stateString query returns every display flag instead of one query per flag
+            state_string = cmds.modelEditor(model_panel, q=True, stateString=True)
+
+            flag_values = {}
+            for flag, value in BPlayblast._STATE_STRING_FLAG_RE.findall(state_string):
+                if flag in BPlayblast._FLAG_NAMES:
+                    flag_values[flag] = value not in ("0", "off", "false")
+
             for item in BPlayblast.VIEWPORT_VISIBILITY_LOOKUP:
-                kwargs = {item[1]: True}
-                viewport_visibility.append(cmds.modelEditor(model_panel, q=True, **kwargs))
-        except:
+                if item[1] in flag_values:
+                    viewport_visibility.append(flag_values[item[1]])
+                else:
+                    kwargs = {item[1]: True}
+                    viewport_visibility.append(cmds.modelEditor(model_panel, q=True, **kwargs))
+        except (RuntimeError, TypeError):
             traceback.print_exc()
             self.log_error("Failed to get active viewport visibility. See script editor.")
             return None
@@ -459,47 +816,51 @@ class BPlayblast(QtCore.QObject):
         cmds.modelEditor(model_editor, e=True, **visibility_flags)
 
     def create_viewport_visibility_flags(self, visibility_data):
-        visibility_flags = {}
+        return dict.fromkeys(BPlayblast._VISIBILITY_FLAG_KEYS, visibility_data)
 
-        data_index = 0
-        for item in BPlayblast.VIEWPORT_VISIBILITY_LOOKUP:
-            visibility_flags[item[1]] = visibility_data
-            data_index += 1
+    def _resolve_tokens(self, text):
+        # Tokens are only queried when present, unknown tokens and other braces are left as written
+        resolvers = {
+            "project": self.get_project_dir_path,
+            "scene": self.get_scene_name
+        }
+        resolved = {}
 
-        return visibility_flags
+        def replace_token(match):
+            token = match.group(1)
+            if token not in resolvers:
+                return match.group(0)
 
-    def resolve_output_directory_path(self, dir_path):
-        if "{project}" in dir_path:
-            dir_path = dir_path.replace("{project}", self.get_project_dir_path())
+            if token not in resolved:
+                resolved[token] = resolvers[token]()
 
-        return dir_path
-    
-    def resolve_output_filename(self, filename):
-        if "{scene}" in filename:
-            filename = filename.replace("{scene}", self.get_scene_name())
+            return resolved[token]
 
-        return filename
+        return BPlayblast._TOKEN_RE.sub(replace_token, text)
 
     def resolve_frame_range(self, frame_range):
-        try:
-            if type(frame_range) in [list, tuple]:
-                start_frame = frame_range[0]
-                end_frame = frame_range[1]
-            else:
-                start_frame, end_frame = self.preset_to_frame_range(frame_range)
+        if isinstance(frame_range, (list, tuple)) and len(frame_range) == 2:
+            return [frame_range[0], frame_range[1]]
 
+        if isinstance(frame_range, str) and frame_range in BPlayblast._FRAME_RANGE_PRESETS_SET:
+            start_frame, end_frame = self.preset_to_frame_range(frame_range)
             return [start_frame, end_frame]
 
-        except:
-            presets = [f"'{preset}'" for preset in BPlayblast.FRAME_RANGE_PRESETS]
-            self.log_error(f"Invalid frame range. Expected one of (start_frame, end_frame) or {', '.join(presets)}")
+        self.log_error(f"Invalid frame range. Expected one of (start_frame, end_frame) or {BPlayblast._FRAME_RANGE_PRESETS_STR}")
 
-            return None
+        return None
         
     def requires_ffmpeg(self):
         return self._container_format != "Image"
 
     def execute(self, output_dir, filename, padding=4, show_ornaments=True, show_in_viewer=True, overwrite=False):
+        self._exec_cache = {}
+        try:
+            self._execute(output_dir, filename, padding, show_ornaments, show_in_viewer, overwrite)
+        finally:
+            self._exec_cache = None
+
+    def _execute(self, output_dir, filename, padding, show_ornaments, show_in_viewer, overwrite):
         if self.requires_ffmpeg() and not self.validate_ffmpeg():
             self.log_error("ffmpeg executable is not configured. See script editor for details.")
             return
@@ -516,102 +877,135 @@ class BPlayblast(QtCore.QObject):
             self.log_error("Output file name not set")
             return
 
-        output_dir = self.resolve_output_directory_path(output_dir)
-        filename = self.resolve_output_filename(filename)
+        output_dir = os.path.normpath(self._resolve_tokens(output_dir))
+        filename = self._resolve_tokens(filename)
         
         if padding <= 0:
             padding = BPlayblast.DEFAULT_PADDING
 
         if self.requires_ffmpeg():
-            output_path = os.path.normpath(os.path.join(output_dir, f"{filename}.{self._container_format}"))
+            output_path = os.path.join(output_dir, f"{filename}.{self._container_format}")
             if not overwrite and os.path.exists(output_path):
                 self.log_error(f"Output file already exists. Enable overwrite to ignore.")
                 return
 
-            playblast_output_dir = f"{output_dir}/playblast_temp"
-            playblast_output = os.path.normpath(os.path.join(playblast_output_dir, filename))
+            if self._encoder != "h264":
+                self.log_error(f"Encoding failed. Unsupported encoder ({self._encoder}) for container ({self._container_format})")
+                return
+
+            # Frames are captured one at a time into a single scratch image and streamed to ffmpeg.
+            # QTemporaryDir removes the directory when scratch_dir goes out of scope, on every return path.
+            scratch_dir = QtCore.QTemporaryDir(os.path.join(self.get_scratch_root_path(), "bplayblast_XXXXXX"))
+            if not scratch_dir.isValid():
+                self.log_error(f"Failed to create temporary directory: {scratch_dir.errorString()}")
+                return
+
+            playblast_output_dir = QtCore.QDir.toNativeSeparators(scratch_dir.path())
+            playblast_output = os.path.join(playblast_output_dir, "frame.png")
             force_overwrite = True
             compression = "png"
             image_quality = 100
-            index_from_zero = True
             viewer = False
 
         else:
-            playblast_output = os.path.normpath(os.path.join(output_dir, filename))
+            playblast_output = os.path.join(output_dir, filename)
             force_overwrite = overwrite
             compression = self._encoder
             image_quality = self._image_quality
-            index_from_zero = False
             viewer = show_in_viewer 
 
         width_height = self.get_resolution_width_height()
         start_frame, end_frame = self.get_start_end_frame()
         
         options = {
-            "filename": playblast_output,
             "widthHeight": width_height,
             "percent": 100,
-            "startTime": start_frame,
-            "endTime": end_frame,
             "clearCache": True,
             "forceOverwrite": force_overwrite,
             "format": "image",
             "compression": compression,
             "quality": image_quality,
-            "indexFromZero": index_from_zero,
-            "framePadding": padding,
             "showOrnaments": show_ornaments,
             "viewer": viewer
         }
 
-        self.log_output(f"Playblast options: {options}")
+        if self.requires_ffmpeg():
+            options["completeFilename"] = playblast_output
+        else:
+            options["filename"] = playblast_output
+            options["startTime"] = start_frame
+            options["endTime"] = end_frame
+            options["indexFromZero"] = False
+            options["framePadding"] = padding
+
+        if self.has_log_listeners():
+            self.log_output(f"Playblast options: {options}")
 
         # Store original viewport settings
-        orig_camera = self.get_active_camera()
+        orig_camera = self._get_active_camera_on_panel(viewport_model_panel)
 
         camera = self._camera
         if not camera:
             camera = orig_camera
 
-        if not camera in cmds.listCameras():
+        if not camera in self.get_valid_cameras():
             self.log_error(f"Camera does not exists: {camera}")
             return
-        
-        self.set_active_camera(camera)
 
-        playblast_failed = False
+        if self.requires_ffmpeg():
+            QtCore.QDir().mkpath(output_dir)
+
+            if not self.encode_h264(output_path, start_frame):
+                return
+
+        playblast_failed = True
         try:
-            cmds.playblast(**options)
-        except:
+            self._set_active_camera_on_panel(camera, viewport_model_panel)
+
+            if self.requires_ffmpeg():
+                playblast_failed = not self.stream_playblast_frames(options, playblast_output, start_frame, end_frame)
+            else:
+                cmds.playblast(**options)
+                playblast_failed = False
+        except Exception:
             traceback.print_exc()
             self.log_error("Failed to created playblast. See script editor for details")
-            playblast_failed = True
         finally:
-            # Restore original viewport settings
-            self.set_active_camera(orig_camera)
+            try:
+                # Restore original viewport settings
+                self._set_active_camera_on_panel(orig_camera, viewport_model_panel)
+            finally:
+                # The encode started above must be ended on every path, or ffmpeg waits on stdin forever
+                if self.requires_ffmpeg():
+                    if playblast_failed:
+                        self.abort_ffmpeg_cmd()
+                        # ffmpeg -y already created the output, don't leave a truncated file blocking the next run
+                        QtCore.QFile.remove(output_path)
+                    else:
+                        self.finish_ffmpeg_cmd(output_path, show_in_viewer)
+
+    def stream_playblast_frames(self, options, frame_path, start_frame, end_frame):
+        for frame in range(int(start_frame), int(end_frame) + 1):
+            # The scratch frame is reused, remove it so a failed capture can't resend the previous frame
+            QtCore.QFile.remove(frame_path)
+
+            if not cmds.playblast(frame=frame, **options) or not os.path.isfile(frame_path):
+                self.log_error(f"Playblast interrupted or failed at frame {frame}")
+                return False
+
+            with open(frame_path, "rb") as frame_file:
+                frame_data = frame_file.read()
+
+            if not self.write_ffmpeg_frame(frame_data):
+                self.log_error(f"ffmpeg stopped before frame {frame} was written. See script editor for details")
+                return False
 
-        if playblast_failed:
-            return
-        
-        if self.requires_ffmpeg():
-            source_path = f"{playblast_output_dir}/{filename}.%0{padding}d.png"
-
-            if self._encoder == "h264":
-                self.encode_h264(source_path, output_path, start_frame)
-            else:
-                self.log_error(f"Encoding failed. Unsupported encoder ({self._encoder}) for container ({self._container_format})")
-                self.remove_temp_dir(playblast_output_dir)
-                return
-            
-            self.remove_temp_dir(playblast_output_dir)
-
-            if show_in_viewer:
-                self.open_in_viewer(output_path)
+        return True
 
 
 if __name__ == "__main__":
 
-    playblast = BPlayblast()
+    playblast = BPlayblast._default()
     playblast.set_camera("rendercam")
     #playblast.set_encoding("Image", "jpg")
     playblast.execute("E:/BASA/test", "output")